@@ -1,11 +1,65 @@
-from lark import Tree, Visitor, Token
+from lark import Tree, Token
+from array import array
 from enum import Enum
-import difflib
+from functools import lru_cache
 from errors import Formatter
 from exceptions import UnknownLabelException, ImmediateOutOfRangeException
 
+try:
+    from rapidfuzz import process, fuzz
+except ImportError:
+    process = None
+    import difflib
 
-class Assembler(Visitor):
+
+@lru_cache(maxsize=256)
+def _find_closest_label(token: str, keys: tuple[str, ...]):
+    """
+    Returns the key most similar to token, or None if nothing is close enough.
+    """
+    if process is not None:
+        # fuzz.ratio is close to, but not the same as, difflib's similarity score, and a
+        # cutoff of 60 mirrors get_close_matches' default of 0.6. Ties are broken like
+        # difflib, by the largest key, so suggestions only differ on borderline scores.
+        matches = process.extract(token, keys, scorer=fuzz.ratio, score_cutoff=60, limit=None)
+        if not matches:
+            return None
+        return max(matches, key=lambda m: (m[1], m[0]))[0]
+
+    closest_matches = difflib.get_close_matches(token, keys, n=1)
+    return closest_matches[0] if closest_matches else None
+
+
+# Operand kinds, classified once per token when a statement is processed
+_REGISTER, _LABEL, _IMMEDIATE = range(3)
+_OPERAND_KINDS = {"REGISTER": _REGISTER, "CNAME": _LABEL, "NUMBER": _IMMEDIATE}
+
+
+def _r_type(prefix: int, args: list[int]):
+    return prefix | args[0] << 5 | args[1] << 2 | args[2]
+
+
+def _i_type(prefix: int, args: list[int]):
+    machine = prefix | args[0] << 5
+    if len(args) > 1:
+        machine |= args[1]
+    return machine
+
+
+def _j_type(prefix: int, args: list[int]):
+    machine = prefix
+    if args:
+        machine |= args[0]
+    return machine
+
+
+def _nop_type(prefix: int, args: list[int]):
+    if args:
+        return prefix | args[0]
+    return prefix
+
+
+class Assembler:
     class OpCode(Enum):
         ADD = 0b0000
         SUB = 0b0001
@@ -22,15 +76,20 @@ class Assembler(Visitor):
         JR = 0b1100
         NOP = 0b1101
 
-    def __init__(self, text, file_name):
+    def __init__(self, text, file_name, keep_debug=True):
         self._statement_counter = 0
         self._data_counter = 0
         self._labels = {}
         self._data_decls = {}
-        self._identifiers = []
-        self._instructions = []
+        self._symbols = {}
+        self._all_label_keys = ()
+        self._identifiers = set()
+        self._instr_ops = []
+        self._instr_operands = []
         self._data = []
-        self._machine_code = []
+        self._code_words = array("H")
+        self._code_debug = []
+        self._keep_debug = keep_debug
         self._text = text
         self._file_name = file_name
 
@@ -38,16 +97,27 @@ class Assembler(Visitor):
         """
         Processes a statement node from the parse tree.
         Extracts any label and maps it to the current instruction index.
-        Extracts and stores the instruction opcode and its tokens.
+        Extracts and stores the instruction opcode and its tokens, recording any
+        identifiers the operands reference.
         """
-        label = list(tree.find_data("label"))
-        if len(label) > 0:
-            label = label[0].children[0].value
-            self._labels[label] = self._statement_counter
-        instr = next(tree.find_data("instruction")).children[0]
-        op = self.OpCode[instr.data.upper()]
-        tokens = instr.scan_values(lambda v: isinstance(v, Token))
-        self._instructions.append((op, tokens))
+        children = tree.children
+        instr_idx = 0
+        if children[0].data == "label":
+            self._labels[children[0].children[0].value] = self._statement_counter
+            # A label may be followed by a NEWLINE before the instruction
+            instr_idx = 2 if isinstance(children[1], Token) else 1
+        instr = children[instr_idx].children[0]
+        op = _OP_BY_NAME[instr.data]
+        operands = []
+        for child in instr.children:
+            # Operands are either REGISTER tokens or value -> identifier/immediate -> token
+            token = child if isinstance(child, Token) else child.children[0].children[0]
+            kind = _OPERAND_KINDS[token.type]
+            if kind == _LABEL:
+                self._identifiers.add(token.value)
+            operands.append((kind, token))
+        self._instr_ops.append(op)
+        self._instr_operands.append(operands)
         self._statement_counter += 1
 
     def data_decl(self, tree: Tree):
@@ -61,32 +131,44 @@ class Assembler(Visitor):
         self._data.append((self.OpCode.NOP, token))
         self._data_counter += 1
 
-    def identifier(self, tree: Tree):
-        self._identifiers.append(tree.children[0].value)
-
     def visit(self, tree):
         """
         Walks parse tree and resolves labels to absolute addresses.
         """
-        new_tree = super().visit(tree)
+        # Statements and data declarations are fully handled by their callbacks,
+        # so the walk never descends below them
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            match node.data:
+                case "statement":
+                    self.statement(node)
+                case "data_decl":
+                    self.data_decl(node)
+                case _:
+                    stack.extend(c for c in reversed(node.children) if isinstance(c, Tree))
 
         # Move data section after instructions in memory
         self._data_decls = {k: v + self._statement_counter for k, v in self._data_decls.items()}
+        self._symbols = {**self._data_decls, **self._labels}
+        self._all_label_keys = tuple(self._symbols)
+
+        # Every statement and data declaration emits exactly one word
+        size = self._statement_counter + self._data_counter
+        self._code_words = array("H", [0]) * size
+        if self._keep_debug:
+            self._code_debug = [None] * size
 
         # Resolve labels
-        for op, tokens in self._instructions:
+        for addr, (op, operands) in enumerate(zip(self._instr_ops, self._instr_operands)):
             args = []
-            for token in tokens:
-                value = -1
-                match token.type:
-                    case "REGISTER":
-                        value = int(token[1:])
-                    case "CNAME":
-                        value = self._find_label_addr(token)
-                    case "NUMBER":
-                        value = int(token, 0)
-                    case _:
-                        raise ValueError(token)
+            for kind, token in operands:
+                if kind == _REGISTER:
+                    value = int(token[1:])
+                elif kind == _LABEL:
+                    value = self._find_label_addr(token)
+                else:
+                    value = int(token, 0)
 
                 if not 0 <= value <= 31:
                     e = ImmediateOutOfRangeException()
@@ -95,21 +177,24 @@ class Assembler(Visitor):
 
                 args.append(value)
 
-            self._machine_code.append((self._opcode_to_machine(op, args), (op, args)))
+            self._code_words[addr] = self._opcode_to_machine(op, args)
+            if self._keep_debug:
+                self._code_debug[addr] = (op, args)
 
         # Fill data section
-        for op, token in self._data:
+        for addr, (op, token) in enumerate(self._data, self._statement_counter):
             value = int(token)
             if not 0 <= value <= 31:
                 e = ImmediateOutOfRangeException()
                 e.token = token
                 raise e
-            self._machine_code.append((self._opcode_to_machine(op, args), (op, args)))
+            # Data words are emitted as the opcode with the value as a 5-bit immediate
+            self._code_words[addr] = _OP_PREFIX[op] | value
+            if self._keep_debug:
+                self._code_debug[addr] = (op, [value])
 
         # Warn for unused data
-        declared = set(self._data_decls.keys())
-        used = set(self._identifiers)
-        unused = declared - used
+        unused = self._data_decls.keys() - self._identifiers
         for item in unused:
             print(
                 Formatter.fmt(
@@ -123,25 +208,16 @@ class Assembler(Visitor):
                 )
             )
 
-        return new_tree
-
-    def _find_closest_label(self, token):
-        all_keys = list(self._labels.keys()) + list(self._data_decls.keys())
-        closest_matches = difflib.get_close_matches(token, all_keys, n=1)
-
-        return closest_matches[0] if closest_matches else None
+        return tree
 
     def _find_label_addr(self, token):
-        try:
-            return self._labels[token]
-        except KeyError:
-            try:
-                return self._data_decls[token]
-            except KeyError:
-                e = UnknownLabelException()
-                e.closest = self._find_closest_label(token)
-                e.token = token
-                raise e
+        addr = self._symbols.get(token)
+        if addr is None:
+            e = UnknownLabelException()
+            e.closest = _find_closest_label(str(token), self._all_label_keys)
+            e.token = token
+            raise e
+        return addr
 
     def _opcode_to_machine(self, op: OpCode, args: list[int]):
         """
@@ -174,42 +250,41 @@ class Assembler(Visitor):
             [ 4 bits opcode | 7 bits zero ]
 
         """
-
-        def r_type(op, args):
-            return op.value << 7 | args[0] << 5 | args[1] << 2 | args[2] & 0b11111111111
-
-        def i_type(op, args):
-            machine = op.value << 7 | args[0] << 5
-            if len(args) > 1:
-                machine |= args[1]
-            return machine & 0b11111111111
-
-        def j_type(op, args):
-            machine = op.value << 7
-            if args:
-                machine |= args[0]
-            return machine & 0b11111111111
-
-        match op:
-            case self.OpCode.ADD | self.OpCode.SUB | self.OpCode.SLT:
-                return r_type(op, args)
-            case (
-                self.OpCode.LI
-                | self.OpCode.LW
-                | self.OpCode.SW
-                | self.OpCode.BEQ
-                | self.OpCode.BNE
-                | self.OpCode.PUSH
-                | self.OpCode.POP
-            ):
-                return i_type(op, args)
-            case self.OpCode.J | self.OpCode.JAL | self.OpCode.JR:
-                return j_type(op, args)
-            case self.OpCode.NOP:
-                if args:
-                    return self.OpCode.NOP.value << 7 | args[0] & 0b11111111111
-                return self.OpCode.NOP.value << 7 & 0b11111111111
+        # Operands are range checked before encoding, so the word always fits in 11 bits
+        machine = _ENCODERS[op](_OP_PREFIX[op], args)
+        assert machine == machine & 0b11111111111
+        return machine
 
     @property
     def machine_code(self):
-        return self._machine_code
+        return self._code_words
+
+    @property
+    def debug_info(self):
+        """
+        (opcode, args) for each machine code word, empty unless keep_debug was set.
+        """
+        return self._code_debug
+
+
+_ENCODERS = {
+    Assembler.OpCode.ADD: _r_type,
+    Assembler.OpCode.SUB: _r_type,
+    Assembler.OpCode.SLT: _r_type,
+    Assembler.OpCode.LI: _i_type,
+    Assembler.OpCode.LW: _i_type,
+    Assembler.OpCode.SW: _i_type,
+    Assembler.OpCode.BEQ: _i_type,
+    Assembler.OpCode.BNE: _i_type,
+    Assembler.OpCode.PUSH: _i_type,
+    Assembler.OpCode.POP: _i_type,
+    Assembler.OpCode.J: _j_type,
+    Assembler.OpCode.JAL: _j_type,
+    Assembler.OpCode.JR: _j_type,
+    Assembler.OpCode.NOP: _nop_type,
+}
+
+_OP_PREFIX = {op: op.value << 7 for op in Assembler.OpCode}
+
+# Grammar rule aliases are the lowercase opcode names
+_OP_BY_NAME = {op.name.lower(): op for op in Assembler.OpCode}
@@ -2,6 +2,19 @@ from colorama import Style, Fore
 from lark import UnexpectedCharacters, UnexpectedEOF, UnexpectedToken, Token
 from exceptions import UnknownLabelException, ImmediateOutOfRangeException
 from enum import Enum, auto
+from bisect import bisect_left
+from functools import lru_cache
+import re
+
+
+# Only the source currently being assembled is kept
+@lru_cache(maxsize=1)
+def _line_bounds(text: str):
+    """
+    Returns the offsets of every newline in text, bracketed by -1 and len(text)
+    so that any position falls between two entries.
+    """
+    return (-1, *(m.start() for m in re.finditer("\n", text)), len(text))
 
 
 class Formatter:
@@ -12,84 +25,17 @@ class Formatter:
 
     @staticmethod
     def fmt_exc(file_name: str, text: str, e: Exception):
-        match e:
-            case UnexpectedCharacters():
-                return Formatter.fmt(
-                    file_name,
-                    text,
-                    "unknown directive." if e.char == "." else "unexpected character.",
-                    e.line,
-                    e.column,
-                    e.pos_in_stream,
-                )
-            case UnexpectedEOF():
-                return Formatter.fmt(
-                    file_name,
-                    text,
-                    "unexpected EOF.",
-                    e.line,
-                    e.column,
-                    e.pos_in_stream,
-                    e.token,
-                )
-            case UnexpectedToken():
-                if "COMMA" in e.expected:
-                    help = ", did you forget a comma?"
-                elif "COLON" in e.expected:
-                    help = ", did you forget a colon?"
-                else:
-                    help = "."
-
-                err = Formatter.fmt(
-                    file_name,
-                    text,
-                    f"unexpected token '{e.token}'{help}",
-                    e.line,
-                    e.column,
-                    e.token.start_pos,
-                    e.token,
-                )
-
-                if help == ".":
-                    err += "\n\nexpected one of:\n"
-                    for item in e.expected:
-                        err += f"   {item}\n"
-
-                return err
-            case UnknownLabelException():
-                message = f"unexpected label '{e.token}'"
-                if e.closest:
-                    message += f", did you mean '{e.closest}'?"
-                else:
-                    message += "."
-                return Formatter.fmt(
-                    file_name,
-                    text,
-                    message,
-                    e.token.line,
-                    e.token.column,
-                    e.token.start_pos,
-                    e.token,
-                )
-            case ImmediateOutOfRangeException():
-                return Formatter.fmt(
-                    file_name,
-                    text,
-                    "immediate out of range.",
-                    e.token.line,
-                    e.token.column,
-                    e.token.start_pos,
-                    e.token,
-                )
-            case _:
-                return Formatter.fmt(
-                    file_name,
-                    text,
-                    str(e),
-                    -1,
-                    -1,
-                    -1,
-                )
+        handler = _EXC_HANDLERS.get(type(e))
+        if handler:
+            return handler(file_name, text, e)
+        return Formatter.fmt(
+            file_name,
+            text,
+            str(e),
+            -1,
+            -1,
+            -1,
+        )
 
     @staticmethod
     def fmt(
@@ -109,32 +55,122 @@ class Formatter:
             token_span = token.end_pos - token.start_pos
             token_underline = f"{'~' * (token_span - 1)}"
 
-        context_start = max(pos - context_span, 0)
-        context_end = pos + context_span
-        context_before = text[context_start:pos].rsplit("\n", 1)[-1]
-        context_after = text[pos:context_end].split("\n", 1)[0]
-
         file_and_loc = f"{Style.BRIGHT}{file_name}"
-        if line > -1 and column > -1:
-            file_and_loc += f":{line}:{column}"
-
-        match level:
-            case Formatter.Level.INFO:
-                formatted_message = f"{Fore.GREEN}info:{Style.RESET_ALL} {message}"
-                context = f"{context_before}{Style.BRIGHT}{Fore.GREEN}{context_after}{Style.RESET_ALL}"
-                pointer = f"{' ' * len(context_before.expandtabs())}{Style.BRIGHT}{Fore.GREEN}^{token_underline}{Style.RESET_ALL}"
-            case Formatter.Level.WARNING:
-                formatted_message = f"{Fore.YELLOW}warning:{Style.RESET_ALL} {message}"
-                context = f"{context_before}{Style.BRIGHT}{Fore.YELLOW}{context_after}{Style.RESET_ALL}"
-                pointer = f"{' ' * len(context_before.expandtabs())}{Style.BRIGHT}{Fore.YELLOW}^{token_underline}{Style.RESET_ALL}"
-            case Formatter.Level.ERROR:
-                formatted_message = f"{Fore.RED}error:{Style.RESET_ALL} {message}"
-                context = f"{context_before}{Style.BRIGHT}{Fore.RED}{context_after}{Style.RESET_ALL}"
-                pointer = f"{' ' * len(context_before.expandtabs())}{Style.BRIGHT}{Fore.RED}^{token_underline}{Style.RESET_ALL}"
-
-        formatted = f"{file_and_loc}: {formatted_message}"
-        if line > -1 and column > -1:
-            formatted += f"\n    {line} | {context}\n"
-            formatted += f"    {' ' * len(str(line))} | {pointer}"
+        msg_prefix, color = _LEVEL_STYLE[level]
+        formatted_message = f"{msg_prefix} {message}"
+
+        # Without a location there is no source context to show
+        if line < 0 or column < 0:
+            return f"{file_and_loc}: {formatted_message}"
+
+        context_before = context_after = ""
+        if pos > -1:
+            newlines = _line_bounds(text)
+            line_idx = bisect_left(newlines, pos)
+            context_start = max(newlines[line_idx - 1] + 1, pos - context_span)
+            context_end = min(newlines[line_idx], pos + context_span)
+            context_before = text[context_start:pos]
+            context_after = text[pos:context_end]
+
+        context = f"{context_before}{color}{context_after}{Style.RESET_ALL}"
+        pointer = f"{' ' * len(context_before.expandtabs())}{color}^{token_underline}{Style.RESET_ALL}"
+
+        formatted = f"{file_and_loc}:{line}:{column}: {formatted_message}"
+        formatted += f"\n    {line} | {context}\n"
+        formatted += f"    {' ' * len(str(line))} | {pointer}"
 
         return formatted
+
+
+def _fmt_unexpected_characters(file_name: str, text: str, e: UnexpectedCharacters):
+    return Formatter.fmt(
+        file_name,
+        text,
+        "unknown directive." if e.char == "." else "unexpected character.",
+        e.line,
+        e.column,
+        e.pos_in_stream,
+    )
+
+
+def _fmt_unexpected_eof(file_name: str, text: str, e: UnexpectedEOF):
+    return Formatter.fmt(
+        file_name,
+        text,
+        "unexpected EOF.",
+        e.line,
+        e.column,
+        e.pos_in_stream,
+        e.token,
+    )
+
+
+def _fmt_unexpected_token(file_name: str, text: str, e: UnexpectedToken):
+    if "COMMA" in e.expected:
+        help = ", did you forget a comma?"
+    elif "COLON" in e.expected:
+        help = ", did you forget a colon?"
+    else:
+        help = "."
+
+    err = Formatter.fmt(
+        file_name,
+        text,
+        f"unexpected token '{e.token}'{help}",
+        e.line,
+        e.column,
+        e.token.start_pos,
+        e.token,
+    )
+
+    if help == ".":
+        err += "\n\nexpected one of:\n"
+        for item in e.expected:
+            err += f"   {item}\n"
+
+    return err
+
+
+def _fmt_unknown_label(file_name: str, text: str, e: UnknownLabelException):
+    message = f"unexpected label '{e.token}'"
+    if e.closest:
+        message += f", did you mean '{e.closest}'?"
+    else:
+        message += "."
+    return Formatter.fmt(
+        file_name,
+        text,
+        message,
+        e.token.line,
+        e.token.column,
+        e.token.start_pos,
+        e.token,
+    )
+
+
+def _fmt_immediate_out_of_range(file_name: str, text: str, e: ImmediateOutOfRangeException):
+    return Formatter.fmt(
+        file_name,
+        text,
+        "immediate out of range.",
+        e.token.line,
+        e.token.column,
+        e.token.start_pos,
+        e.token,
+    )
+
+
+_EXC_HANDLERS = {
+    UnexpectedCharacters: _fmt_unexpected_characters,
+    UnexpectedEOF: _fmt_unexpected_eof,
+    UnexpectedToken: _fmt_unexpected_token,
+    UnknownLabelException: _fmt_unknown_label,
+    ImmediateOutOfRangeException: _fmt_immediate_out_of_range,
+}
+
+# Per-level (message prefix, highlight color) used by Formatter.fmt
+_LEVEL_STYLE = {
+    Formatter.Level.INFO: (f"{Fore.GREEN}info:{Style.RESET_ALL}", f"{Style.BRIGHT}{Fore.GREEN}"),
+    Formatter.Level.WARNING: (f"{Fore.YELLOW}warning:{Style.RESET_ALL}", f"{Style.BRIGHT}{Fore.YELLOW}"),
+    Formatter.Level.ERROR: (f"{Fore.RED}error:{Style.RESET_ALL}", f"{Style.BRIGHT}{Fore.RED}"),
+}
@@ -19,39 +19,43 @@ def main():
 
     with open(args.infile) as infile:
         text = infile.read()
-        with open("grammar.lark") as grammar:
-            parser = Lark(grammar=grammar, start="program", propagate_positions=True, parser="lalr")
-
-            try:
-                tree = parser.parse(text)
-
-                if DEBUG:
-                    print(tree.pretty())
-
-                assembler = Assembler(text, args.infile)
-                assembler.visit(tree)
-                code = assembler.machine_code
-
-                if args.o and args.o != "-":
-                    with open(args.o, "w") as outfile:
-                        for line, _ in code:
-                            outfile.write(f"{line:011b}\n")
-                else:
-                    width = len(str(len(code) - 1))
-                    for i, (line, instr) in enumerate(code):
-                        print(f"{i:{width}}: {line:011b} -- {instr[0].name.lower()} {instr[1]}")
-
-            except Exception as e:
-                if DEBUG:
-                    traceback_str = "".join(traceback.format_tb(e.__traceback__))
-                    print(traceback_str)
-                    print(e)
-
-                print(Formatter.fmt_exc(args.infile, text, e))
-
-                if DEBUG:
-                    print(type(e))
-                sys.exit(1)
+        parser = Lark.open(
+            "grammar.lark", start="program", propagate_positions=True, parser="lalr", cache=".lark_cache.bin"
+        )
+
+        try:
+            tree = parser.parse(text)
+
+            if DEBUG:
+                print(tree.pretty())
+
+            to_file = args.o and args.o != "-"
+            assembler = Assembler(text, args.infile, keep_debug=not to_file)
+            assembler.visit(tree)
+            code = assembler.machine_code
+
+            if to_file:
+                with open(args.o, "wb") as outfile:
+                    outfile.write("".join(f"{word:011b}\n" for word in code).encode("ascii"))
+            else:
+                width = len(str(len(code) - 1))
+                listing = [
+                    f"{i:{width}}: {word:011b} -- {op.name.lower()} {op_args}\n"
+                    for i, (word, (op, op_args)) in enumerate(zip(code, assembler.debug_info))
+                ]
+                sys.stdout.write("".join(listing))
+
+        except Exception as e:
+            if DEBUG:
+                traceback_str = "".join(traceback.format_tb(e.__traceback__))
+                print(traceback_str)
+                print(e)
+
+            print(Formatter.fmt_exc(args.infile, text, e))
+
+            if DEBUG:
+                print(type(e))
+            sys.exit(1)
 
 
 if __name__ == "__main__":